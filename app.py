@@ -1,17 +1,39 @@
 import os
+import time
 import requests
-import polyline
 import json
-from flask import Flask, redirect, request, jsonify, session, render_template, url_for
+import hashlib
+import multiprocessing
+import threading
+import numpy as np
+import orjson
+import shapely
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from flask import Flask, Response, redirect, request, jsonify, session, render_template, url_for
+from flask.json.provider import JSONProvider
 from dotenv import load_dotenv
-from datetime import datetime
-from shapely.geometry import Point, Polygon, shape
-from shapely.prepared import prep
+from shapely.geometry import Polygon, shape
 from sqlalchemy import create_engine, text
 
+class OrjsonProvider(JSONProvider):
+    """Sérialisation JSON via orjson : bien plus rapide que json, et gère les tableaux numpy."""
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.option), mimetype='application/json')
+
 # 1. Configuration initiale
 load_dotenv()
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = os.getenv('SECRET_KEY', 'dev_secret_key_123')
 
 # --- CONFIGURATION DATABASE (SUPABASE) ---
@@ -32,65 +54,277 @@ SPORT_TRANSLATIONS = {
 }
 GPS_SPORTS = list(SPORT_TRANSLATIONS.keys())
 
+STRAVA_ACTIVITIES_URL = "https://www.strava.com/api/v3/athlete/activities"
+STRAVA_PAGE_SIZE = 200
+STRAVA_MAX_PAGES = 10
+STRAVA_PARALLEL_PAGES = 3 # Pages demandées en parallèle une fois la première page pleine
+
+# Une case de grille = un entier : (i + BIAS) * MOD + (j + BIAS), avec i, j les indices lat/lon.
+# |i|, |j| < 2**30 : valable jusqu'à une grille de ~2 cm, et la clé tient dans un int64
+CELL_KEY_MOD = 1 << 32
+CELL_KEY_BIAS = 1 << 30
+MAX_GRID_METERS = 10_000 # Au-delà, une case dépasse la taille d'une commune
+
+# Les traces sont envoyées au front en entiers (degrés * COORD_SCALE), soit la précision d'une polyline (~1 m)
+COORD_SCALE = 1e5
+
 # --- CACHES EN MÉMOIRE (RAM uniquement) ---
-RAW_DATA_CACHE = {}
-API_RESULT_CACHE = {}
+# Bornés en LRU : au-delà, l'utilisateur (ou le résultat) le moins récemment utilisé est oublié
+RAW_DATA_CACHE = OrderedDict()
+API_RESULT_CACHE = OrderedDict() # {token: OrderedDict {cache_key: réponse JSON déjà sérialisée (bytes)}}
+MAX_CACHED_USERS = 20
+MAX_RESULTS_PER_USER = 30
+MUNI_CACHE = OrderedDict() # {(nom_commune, empreinte du contour): {key, name, area_m2, outline, poly_obj}}, partagé entre utilisateurs
+PROBE_CACHE = OrderedDict() # {(lat, lon) arrondis à 0.01: (clés MUNI_CACHE des communes contenant la sonde)}
+MAX_CACHED_COMMUNES = 2_000
+MAX_CACHED_PROBES = 100_000
+MAX_CACHED_GRIDS = 3 # Nombre de tailles de grille dont on garde les cases par activité
+CELLS_CACHE = OrderedDict() # {(hash(polyline), grid_meters): tableau int64 des clés}, LRU partagé entre utilisateurs
+CELLS_CACHE_MAX_CELLS = 5_000_000 # Borne en nombre total de cases (~40 Mo de clés int64)
+_cells_cache_count = 0
+PARALLEL_MIN_ACTIVITIES = 200 # En dessous, passer par les processus coûte plus cher que le calcul
+_cells_pool = None # Pool de processus réutilisé d'une requête à l'autre
+_cells_pool_lock = threading.Lock()
 
 # --- FONCTIONS UTILITAIRES ---
 
+def lru_get(cache, key):
+    value = cache.get(key)
+    if value is not None:
+        # Remis en fin = plus récent ; l'entrée ne quitte jamais le cache (requêtes concurrentes)
+        try: cache.move_to_end(key)
+        except KeyError: pass # Évincée entre-temps par un autre thread
+    return value
+
+def lru_put(cache, key, value, max_size):
+    cache[key] = value
+    while len(cache) > max_size: cache.popitem(last=False)
+
+_db_engine = None
+
+def get_db_engine():
+    """Moteur SQLAlchemy unique : son pool garde les connexions (TCP + TLS + auth) ouvertes d'une requête à l'autre."""
+    global _db_engine
+    if _db_engine is None:
+        _db_engine = create_engine(
+            DB_URL, pool_size=5, max_overflow=5, pool_pre_ping=True, pool_recycle=300,
+            connect_args={'connect_timeout': 3, 'keepalives': 1, 'keepalives_idle': 30}
+        )
+    return _db_engine
+
+def parse_grid_meters():
+    """Taille de grille demandée, ou None si elle n'est pas un entier dans ]0, MAX_GRID_METERS]."""
+    try: grid_meters = int(request.args.get('grid_size', 100))
+    except ValueError: return None
+    return grid_meters if 0 < grid_meters <= MAX_GRID_METERS else None
+
+def user_results(token):
+    """Résultats d'API déjà sérialisés de cet utilisateur."""
+    results = lru_get(API_RESULT_CACHE, token)
+    if results is None:
+        results = OrderedDict()
+        lru_put(API_RESULT_CACHE, token, results, MAX_CACHED_USERS)
+    return results
+
+def decode_polyline_fast(encoded, precision=5):
+    """Décode une polyline Google en un tableau numpy (n, 2) de [lat, lon], sans boucle Python."""
+    if not encoded: return np.empty((0, 2))
+    b = np.frombuffer(encoded.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    ends = np.flatnonzero((b & 0x20) == 0)
+    if len(ends) < 2: return np.empty((0, 2))
+    # On ignore un éventuel dernier chunk tronqué (bit de continuation sans fin)
+    b = b[:ends[-1] + 1]
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    # Position de chaque caractère dans son chunk -> décalage de 5 bits par position
+    pos = np.arange(len(b)) - np.repeat(starts, ends - starts + 1)
+    vals = np.add.reduceat((b & 0x1f) << (5 * pos), starts)
+    # Décodage zigzag (valeur signée), puis cumul des deltas lat/lon
+    deltas = np.where(vals & 1, ~(vals >> 1), vals >> 1)
+    deltas = deltas[:len(deltas) // 2 * 2].reshape(-1, 2)
+    return np.cumsum(deltas, axis=0) / 10 ** precision
+
 def get_cells_from_polyline(pts, grid_size_deg):
-    cells = set()
-    if not pts: return cells
-    prev_lat, prev_lon = pts[0]
-    
-    def to_key(lat, lon):
-        return (round(round(lat/grid_size_deg)*grid_size_deg, 6), 
-                round(round(lon/grid_size_deg)*grid_size_deg, 6))
-
-    cells.add(to_key(prev_lat, prev_lon))
-
-    for i in range(1, len(pts)):
-        curr_lat, curr_lon = pts[i]
-        dist = ((curr_lat - prev_lat)**2 + (curr_lon - prev_lon)**2)**0.5
-        if dist > grid_size_deg * 0.7:
-            num_steps = int(dist / (grid_size_deg * 0.5))
-            for j in range(1, num_steps + 1):
-                frac = j / (num_steps + 1)
-                cells.add(to_key(prev_lat + (curr_lat - prev_lat) * frac, prev_lon + (curr_lon - prev_lon) * frac))
-        cells.add(to_key(curr_lat, curr_lon))
-        prev_lat, prev_lon = curr_lat, curr_lon
+    """Retourne les clés entières (int64 triées, uniques) des cases de la grille traversées par la trace."""
+    pts = np.asarray(pts, dtype=float).reshape(-1, 2)
+    if len(pts) == 0: return np.empty(0, dtype=np.int64)
+
+    # Segments trop longs : on ajoute des points intermédiaires tous les ~0.5 case
+    seg = np.diff(pts, axis=0)
+    dist = np.hypot(seg[:, 0], seg[:, 1])
+    steps = np.where(dist > grid_size_deg * 0.7, (dist / (grid_size_deg * 0.5)).astype(np.int64), 0)
+    total = int(steps.sum())
+    if total:
+        seg_idx = np.repeat(np.arange(len(steps)), steps)
+        j = np.arange(1, total + 1) - np.repeat(np.cumsum(steps) - steps, steps)
+        frac = j / (steps[seg_idx] + 1)
+        pts = np.concatenate((pts, pts[seg_idx] + seg[seg_idx] * frac[:, None]))
+
+    idx = np.round(pts / grid_size_deg).astype(np.int64) + CELL_KEY_BIAS
+    keys = idx[:, 0] * CELL_KEY_MOD + idx[:, 1]
+    return np.unique(keys)
+
+def cell_keys_to_latlon(keys, grid_size_deg):
+    """Reconstruit les coordonnées [lat, lon] (arrondies) des cases à partir de leurs clés."""
+    keys = np.asarray(keys, dtype=np.int64)
+    idx = np.stack((keys // CELL_KEY_MOD, keys % CELL_KEY_MOD), axis=1) - CELL_KEY_BIAS
+    return np.round(idx * grid_size_deg, 6).reshape(-1, 2)
+
+def compute_cells(acts, indices, grid_meters):
+    """Cases des activités `indices` ; en parallèle (un processus par cœur) s'il y en a beaucoup."""
+    global _cells_pool
+    grid_size_deg = grid_meters / 111320
+    # Sur une seule machine mono-cœur, le calcul numpy séquentiel reste le plus rapide
+    if len(indices) >= PARALLEL_MIN_ACTIVITIES and (os.cpu_count() or 1) > 1:
+        try:
+            with _cells_pool_lock: # Deux premières requêtes simultanées ne créent qu'un seul pool
+                if _cells_pool is None:
+                    # forkserver : les fils ne copient pas l'état (threads, connexions) du serveur
+                    _cells_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context('forkserver'))
+                pool = _cells_pool
+            # Les points déjà décodés à l'import partent tels quels : pas de second décodage
+            pts = [acts['pts'][i] for i in indices]
+            return list(pool.map(get_cells_from_polyline, pts, [grid_size_deg] * len(pts), chunksize=64))
+        except Exception as e:
+            # Ex : serverless sans /dev/shm, pool cassé, erreur de pickling -> calcul séquentiel
+            print(f"⚠️ Calcul parallèle indisponible: {e}")
+            with _cells_pool_lock:
+                if _cells_pool is not None: _cells_pool.shutdown(wait=False, cancel_futures=True)
+                _cells_pool = None
+    return [get_cells_from_polyline(acts['pts'][i], grid_size_deg) for i in indices]
+
+def cells_cache_pop(key):
+    global _cells_cache_count
+    cells = CELLS_CACHE.pop(key, None)
+    if cells is not None: _cells_cache_count -= len(cells)
     return cells
 
+def cells_cache_put(key, cells):
+    """Ajoute en fin de LRU, puis évince les plus anciennes traces tant que la borne de cases est dépassée."""
+    global _cells_cache_count
+    cells_cache_pop(key)
+    CELLS_CACHE[key] = cells
+    _cells_cache_count += len(cells)
+    while _cells_cache_count > CELLS_CACHE_MAX_CELLS and CELLS_CACHE:
+        _cells_cache_count -= len(CELLS_CACHE.popitem(last=False)[1])
+
+def get_activity_cells(acts, grid_meters):
+    """Cases de toutes les activités pour une grille, au format CSR : (clés concaténées, offsets).
+    Les cases de l'activité i sont keys[offsets[i]:offsets[i + 1]]."""
+    if grid_meters in acts['cells']: return acts['cells'][grid_meters]
+
+    # On reprend d'abord les traces identiques déjà calculées (même utilisateur ou sortie de groupe)
+    cells = [cells_cache_pop((hash(poly), grid_meters)) for poly in acts['polylines']]
+    missing = [i for i, c in enumerate(cells) if c is None]
+    for i, c in zip(missing, compute_cells(acts, missing, grid_meters)): cells[i] = c
+
+    offsets = np.zeros(len(cells) + 1, dtype=np.int64)
+    np.cumsum([len(c) for c in cells], out=offsets[1:])
+    keys = np.concatenate(cells) if cells else np.empty(0, dtype=np.int64)
+
+    # Le cache partagé reçoit des vues sur le tableau CSR : pas de copie des clés
+    for i, poly in enumerate(acts['polylines']):
+        cells_cache_put((hash(poly), grid_meters), keys[offsets[i]:offsets[i + 1]])
+
+    if len(acts['cells']) >= MAX_CACHED_GRIDS: acts['cells'].pop(next(iter(acts['cells'])))
+    acts['cells'][grid_meters] = (keys, offsets)
+    return keys, offsets
+
+def month_label(month_idx):
+    """Indice de mois (année * 12 + mois - 1) -> "YYYY-MM"."""
+    return f"{month_idx // 12}-{month_idx % 12 + 1:02d}"
+
+def filter_mask(acts, sel_year, sel_sport):
+    """Masque booléen des activités correspondant aux filtres année / sport."""
+    mask = np.ones(len(acts['types']), dtype=bool)
+    if sel_year != 'all': mask &= acts['years'] == sel_year
+    if sel_sport != 'all': mask &= acts['types'] == sel_sport
+    return mask
+
+def commune_key(row):
+    """Identifiant d'une commune : le nom seul ne suffit pas (homonymes), on y ajoute l'empreinte de sa géométrie."""
+    return (row.nom_commune, hashlib.sha1(row.outline.encode()).digest())
+
+def parse_commune_row(row):
+    """Transforme une ligne PostGIS (GeoJSON lon/lat) en commune prête pour Leaflet et Shapely."""
+    geojson_geom = json.loads(row.outline)
+    inverted_outline = []
+    # Inversion Lat/Lon pour Leaflet
+    if geojson_geom['type'] == 'Polygon':
+        inverted_outline = [[p[1], p[0]] for p in geojson_geom['coordinates'][0]]
+    elif geojson_geom['type'] == 'MultiPolygon':
+        inverted_outline = [[p[1], p[0]] for p in geojson_geom['coordinates'][0][0]]
+
+    poly_obj = Polygon(inverted_outline) # Objet Shapely pour calculs précis
+    # Géométrie complète (trous et toutes les parties), en lat/lon : sert à rattacher les sondes
+    # sans confondre une enclave avec la commune qui l'entoure
+    full_geom = shapely.transform(shape(geojson_geom), lambda c: c[:, ::-1])
+    shapely.prepare(poly_obj) # Préparés une fois pour toutes les requêtes suivantes
+    shapely.prepare(full_geom)
+    return {
+        "key": commune_key(row), "name": row.nom_commune, "area_m2": row.area_m2,
+        "outline": inverted_outline, "poly_obj": poly_obj, "full_geom": full_geom
+    }
+
+def communes_of_probes(probes, cities):
+    """Pour chaque sonde (lat, lon), les clés des communes (parmi `cities`) qui la contiennent."""
+    if not probes or not cities: return [()] * len(probes)
+    found = [[] for _ in probes]
+    # Filtre spatial par STRtree : seules les villes dont l'emprise touche la sonde sont testées
+    tree = shapely.STRtree([c['full_geom'] for c in cities])
+    probe_idx, city_idx = tree.query(shapely.points(probes), predicate='intersects')
+    for k, c in zip(probe_idx.tolist(), city_idx.tolist()): found[k].append(cities[c]['key'])
+    return [tuple(n) for n in found]
+
+def fetch_strava_page(http, page):
+    """Une page d'activités Strava (None en cas d'erreur). Un 429 est réessayé une fois après Retry-After."""
+    for attempt in range(2):
+        try:
+            r = http.get(STRAVA_ACTIVITIES_URL, params={'per_page': STRAVA_PAGE_SIZE, 'page': page}, timeout=10)
+            if r.status_code == 429 and attempt == 0:
+                time.sleep(min(int(r.headers.get('Retry-After', 1)), 10))
+                continue
+            return r.json() if r.status_code == 200 else None
+        except: return None
+    return None
+
 def get_strava_activities_cached(token):
-    """Charge les activités une seule fois."""
-    if token in RAW_DATA_CACHE: return RAW_DATA_CACHE[token]
+    """Charge les activités une seule fois, rangées par colonnes (une entrée par activité, ordre chronologique)."""
+    cached = lru_get(RAW_DATA_CACHE, token)
+    if cached is not None: return cached
     
     all_activities = []
-    headers = {'Authorization': f'Bearer {token}'}
-    page = 1
+    page, wave = 1, 1 # La page 1 seule d'abord : si elle n'est pas pleine, inutile d'aller plus loin
+
+    # Une seule session HTTP (connexion keep-alive réutilisée), pages suivantes par vagues parallèles
+    with requests.Session() as http, ThreadPoolExecutor(max_workers=STRAVA_PARALLEL_PAGES) as pool:
+        http.headers['Authorization'] = f'Bearer {token}'
+        while page <= STRAVA_MAX_PAGES:
+            pages = range(page, min(page + wave, STRAVA_MAX_PAGES + 1))
+            last_page_reached = False
+            for data in pool.map(lambda p: fetch_strava_page(http, p), pages):
+                if data: all_activities.extend(data)
+                if not data or len(data) < STRAVA_PAGE_SIZE:
+                    last_page_reached = True
+                    break
+            if last_page_reached: break
+            page, wave = page + len(pages), STRAVA_PARALLEL_PAGES
     
-    while True:
-        try:
-            r = requests.get("https://www.strava.com/api/v3/athlete/activities", headers=headers, params={'per_page': 200, 'page': page}, timeout=10)
-            if r.status_code != 200: break
-            data = r.json()
-            if not data: break
-            all_activities.extend(data)
-            page += 1
-            if page > 10: break
-        except: break
-    
-    cleaned_data = []
-    for act in all_activities:
-        if act.get('type') in GPS_SPORTS and act.get('map', {}).get('summary_polyline'):
-            cleaned_data.append({
-                'type': act['type'],
-                'start_date_local': act['start_date_local'],
-                'polyline': act['map']['summary_polyline'],
-                'distance': act.get('distance', 0)
-            })
-
-    RAW_DATA_CACHE[token] = cleaned_data
+    gps_activities = [act for act in all_activities if act.get('type') in GPS_SPORTS and act.get('map', {}).get('summary_polyline')]
+    gps_activities.sort(key=lambda x: x['start_date_local'])
+    polylines = [act['map']['summary_polyline'] for act in gps_activities]
+
+    # Format de date fixe "%Y-%m-%dT%H:%M:%SZ" : année et mois par découpage de la chaîne
+    cleaned_data = {
+        'types': np.array([act['type'] for act in gps_activities], dtype=str),
+        'years': np.array([act['start_date_local'][:4] for act in gps_activities], dtype=str),
+        'months': np.array([int(act['start_date_local'][:4]) * 12 + int(act['start_date_local'][5:7]) - 1 for act in gps_activities], dtype=np.int32),
+        'distances': np.array([act.get('distance', 0) for act in gps_activities], dtype=float),
+        'polylines': polylines,
+        'pts': [decode_polyline_fast(poly) for poly in polylines],
+        'cells': {} # {grid_meters: (clés, offsets)} au format CSR, rempli à la demande
+    }
+
+    lru_put(RAW_DATA_CACHE, token, cleaned_data, MAX_CACHED_USERS)
     return cleaned_data
 
 # --- ROUTES STANDARD ---
@@ -141,69 +375,57 @@ def get_stats_history():
     token = session.get('access_token')
     if not token: return jsonify({"error": "Login required"}), 401
 
-    grid_meters = int(request.args.get('grid_size', 100))
+    grid_meters = parse_grid_meters()
+    if grid_meters is None: return jsonify({"error": "Invalid grid_size"}), 400
     sel_year = request.args.get('year', 'all')
     sel_sport = request.args.get('sport_type', 'all')
 
     cache_key = f"stats_{grid_meters}_{sel_year}_{sel_sport}"
     
-    if token not in API_RESULT_CACHE: API_RESULT_CACHE[token] = {}
-    if cache_key in API_RESULT_CACHE[token]:
-        return jsonify(API_RESULT_CACHE[token][cache_key])
-
-    activities = get_strava_activities_cached(token)
-    grid_size_deg = grid_meters / 111320
-    activities.sort(key=lambda x: x['start_date_local'])
-
-    monthly_data = {}
-    global_seen = set()
-    available_years = set()
-    available_sports = set()
-    total_blocks = 0
-
-    for act in activities:
-        dt = datetime.strptime(act['start_date_local'], "%Y-%m-%dT%H:%M:%SZ")
-        y_str = str(dt.year)
-        m_key = dt.strftime("%Y-%m")
-        sport = act['type']
-
-        available_years.add(y_str)
-        available_sports.add(sport)
-
-        if sel_year != 'all' and y_str != sel_year: continue
-        if sel_sport != 'all' and sport != sel_sport: continue
-
-        if m_key not in monthly_data: monthly_data[m_key] = {'new': 0, 'routine': 0}
-
-        pts = polyline.decode(act['polyline'])
-        blocks = get_cells_from_polyline(pts, grid_size_deg)
-
-        for b in blocks:
-            if b not in global_seen:
-                global_seen.add(b)
-                monthly_data[m_key]['new'] += 1
-                total_blocks += 1
-            else:
-                monthly_data[m_key]['routine'] += 1
-
-    labels = sorted(monthly_data.keys())
-    conquest, explore, routine = [], [], []
-    running = 0
-    for m in labels:
-        running += monthly_data[m]['new']
-        conquest.append(running)
-        explore.append(monthly_data[m]['new'])
-        routine.append(monthly_data[m]['routine'])
+    results = user_results(token)
+    cached = lru_get(results, cache_key)
+    if cached is not None:
+        return Response(cached, mimetype='application/json')
+
+    acts = get_strava_activities_cached(token)
+    keys, offsets = get_activity_cells(acts, grid_meters)
+    mask = filter_mask(acts, sel_year, sel_sport)
+
+    # Clés des cases des activités retenues (ordre chronologique) et mois de chacune
+    lengths = np.diff(offsets)
+    cell_mask = np.repeat(mask, lengths)
+    sel_keys = keys[cell_mask]
+    sel_months = np.repeat(acts['months'], lengths)[cell_mask]
+
+    # Compteurs par mois dans des tableaux indexés par (mois - premier mois) : une case est
+    # "nouvelle" le mois de sa première apparition, "routine" à chaque passage suivant
+    act_months = acts['months'][mask]
+    min_month = int(act_months.min()) if len(act_months) else 0
+    span = int(act_months.max()) - min_month + 1 if len(act_months) else 0
+    _, first_idx = np.unique(sel_keys, return_index=True)
+    new_arr = np.bincount(sel_months[first_idx] - min_month, minlength=span)
+    rout_arr = np.bincount(sel_months - min_month, minlength=span) - new_arr
+    total_blocks = len(first_idx)
+
+    # Seuls les mois ayant au moins une activité apparaissent dans le graphique
+    present = np.zeros(span, dtype=bool)
+    present[act_months - min_month] = True
+    month_idx = np.flatnonzero(present)
+    labels = [month_label(m + min_month) for m in month_idx.tolist()]
+    conquest = np.cumsum(new_arr)[month_idx].tolist()
+    explore = new_arr[month_idx].tolist()
+    routine = rout_arr[month_idx].tolist()
 
     result = {
         "labels": labels, "conquest": conquest, "exploration": explore, "routine": routine,
         "total_blocks": total_blocks,
-        "available_years": sorted(list(available_years), reverse=True),
-        "available_sports": sorted(list(available_sports))
+        "available_years": sorted(np.unique(acts['years']).tolist(), reverse=True),
+        "available_sports": np.unique(acts['types']).tolist()
     }
 
-    API_RESULT_CACHE[token][cache_key] = result
-    return jsonify(result)
+    body = orjson.dumps(result, option=OrjsonProvider.option)
+    lru_put(results, cache_key, body, MAX_RESULTS_PER_USER)
+    return Response(body, mimetype='application/json')
 
 @app.route('/api/activities')
 def get_activities_route():
@@ -212,81 +434,90 @@ def get_activities_route():
 
     sel_year = request.args.get('year', 'all')
     sel_sport = request.args.get('sport_type', 'all')
-    grid_meters = int(request.args.get('grid_size', 100))
+    grid_meters = parse_grid_meters()
+    if grid_meters is None: return jsonify({"error": "Invalid grid_size"}), 400
     
     cache_key = f"act_{grid_meters}_{sel_year}_{sel_sport}"
-    if token not in API_RESULT_CACHE: API_RESULT_CACHE[token] = {}
-    
-    if cache_key in API_RESULT_CACHE[token]:
-        return jsonify(API_RESULT_CACHE[token][cache_key])
+    results = user_results(token)
+    cached = lru_get(results, cache_key)
+    if cached is not None:
+        return Response(cached, mimetype='application/json')
 
-    activities = get_strava_activities_cached(token)
+    acts = get_strava_activities_cached(token)
     grid_size_deg = grid_meters / 111320
+    keys, offsets = get_activity_cells(acts, grid_meters)
+    mask = filter_mask(acts, sel_year, sel_sport)
 
     data = {
-        "coords": [], "grid_cells": [], "grid_size_used": grid_size_deg,
-        "available_years": set(), "available_sports": {}, "top_municipalities": [],
-        "stats": { "total_distance": 0, "activity_count": 0, "cells_conquered": 0 }
+        "coords": [], "coord_scale": COORD_SCALE, "grid_cells": [], "grid_size_used": grid_size_deg,
+        "available_years": sorted(np.unique(acts['years']).tolist(), reverse=True),
+        "available_sports": dict(sorted(((s, SPORT_TRANSLATIONS.get(s, s)) for s in np.unique(acts['types']).tolist()), key=lambda x: x[1])),
+        "top_municipalities": [],
+        "stats": {
+            "total_distance": float(acts['distances'][mask].sum()) / 1000,
+            "activity_count": int(mask.sum()),
+            "cells_conquered": 0
+        }
     }
     
-    grid_store = {}
-
-    for act in activities:
-        dt = datetime.strptime(act['start_date_local'], "%Y-%m-%dT%H:%M:%SZ")
-        y_str = str(dt.year)
-        sport = act['type']
-        
-        data["available_years"].add(y_str)
-        if sport not in data["available_sports"]:
-            data["available_sports"][sport] = SPORT_TRANSLATIONS.get(sport, sport)
-
-        if (sel_year == 'all' or sel_year == y_str) and (sel_sport == 'all' or sel_sport == sport):
-            pts = polyline.decode(act['polyline'])
-            data["coords"].append(pts)
-            
-            blocks = get_cells_from_polyline(pts, grid_size_deg)
-            act_ym = dt.strftime("%Y-%m")
-
-            for b in blocks:
-                if b not in grid_store:
-                    grid_store[b] = {'cnt': 0, 'first': act_ym, 'last': act_ym}
-                
-                grid_store[b]['cnt'] += 1
-                if act_ym < grid_store[b]['first']: grid_store[b]['first'] = act_ym
-                if act_ym > grid_store[b]['last']: grid_store[b]['last'] = act_ym
-            
-            data["stats"]["total_distance"] += act['distance'] / 1000
-            data["stats"]["activity_count"] += 1
-
-    data["grid_cells"] = [[k[0], k[1], v['cnt'], v['first'], v['last']] for k, v in grid_store.items()]
-    data["stats"]["cells_conquered"] = len(grid_store)
-    data["available_years"] = sorted(list(data["available_years"]), reverse=True)
-    data["available_sports"] = dict(sorted(data["available_sports"].items(), key=lambda x: x[1]))
+    for i in np.flatnonzero(mask).tolist():
+        data["coords"].append((acts['pts'][i] * COORD_SCALE).round().astype(np.int32))
+
+    # Agrégation par case sur tableaux numpy : toutes les clés des activités retenues,
+    # avec le mois de leur activité, puis comptage / premier / dernier mois par clé unique
+    lengths = np.diff(offsets)
+    cell_mask = np.repeat(mask, lengths)
+    sel_keys = keys[cell_mask]
+    sel_months = np.repeat(acts['months'], lengths)[cell_mask]
+
+    grid_keys, inv = np.unique(sel_keys, return_inverse=True)
+    cnt = np.bincount(inv, minlength=len(grid_keys))
+    first = np.full(len(grid_keys), np.iinfo(np.int32).max, dtype=np.int32)
+    last = np.full(len(grid_keys), np.iinfo(np.int32).min, dtype=np.int32)
+    np.minimum.at(first, inv, sel_months)
+    np.maximum.at(last, inv, sel_months)
+
+    labels = {m: month_label(m) for m in np.unique(sel_months).tolist()}
+    cell_arr = cell_keys_to_latlon(grid_keys, grid_size_deg)
+    cell_coords = cell_arr.tolist()
+    data["grid_cells"] = [[lat, lon, c, labels[f], labels[l]] for (lat, lon), c, f, l in zip(cell_coords, cnt.tolist(), first.tolist(), last.tolist())]
+    data["stats"]["cells_conquered"] = len(grid_keys)
 
     # --- CALCUL DES VILLES OPTIMISÉ (BATCH REQUEST) ---
     # Nous utilisons une approche par lots (batch) pour interroger la base de données.
     # Au lieu de vérifier chaque bloc un par un (trop lent), on envoie des paquets de coordonnées.
     
-    if grid_store and DB_URL:
+    if len(grid_keys) and DB_URL:
         identified_cities = {}
         
         # 1. Création de "Sondes" (Probes)
         # On ne garde qu'un point unique tous les ~1km (arrondi 2 décimales)
         # Cela réduit drastiquement le nombre de points à vérifier (ex: 10 000 blocs -> 150 sondes)
         probe_points = set()
-        for lat, lon in grid_store.keys():
+        for lat, lon in cell_coords:
             probe_points.add((round(lat, 2), round(lon, 2)))
         
-        probe_list = list(probe_points)
+        # Les sondes déjà résolues lors d'un appel précédent n'interrogent plus la base
+        pending = []
+        for probe in probe_points:
+            city_keys = lru_get(PROBE_CACHE, probe)
+            cities = [lru_get(MUNI_CACHE, key) for key in city_keys] if city_keys is not None else [None]
+            # Une commune évincée de MUNI_CACHE entre-temps : la sonde repart en base
+            if None in cities:
+                pending.append(probe)
+                continue
+            for city in cities: identified_cities[city['key']] = city
+        # Tri spatial : des sondes voisines tombent dans le même lot (et les mêmes communes)
+        pending.sort()
         
         # 2. Interrogation par paquets (Batch)
         batch_size = 50 # On envoie 50 points d'un coup
         
         try:
-            engine = create_engine(DB_URL)
+            engine = get_db_engine()
             with engine.connect() as conn:
-                for i in range(0, len(probe_list), batch_size):
-                    batch = probe_list[i:i+batch_size]
+                while pending:
+                    batch, pending = pending[:batch_size], pending[batch_size:]
                     
                     # Construction d'un MultiPoint WKT (Well Known Text) pour PostGIS
                     # IMPORTANT: WKT est en format "LON LAT"
@@ -304,25 +535,24 @@ def get_activities_route():
                     
                     result_proxy = conn.execute(query, {"wkt": wkt_multipoint})
                     
-                    # Traitement des résultats bruts
+                    # Traitement des résultats bruts (contours déjà parsés repris de MUNI_CACHE)
+                    batch_cities = []
                     for row in result_proxy:
-                        if row.nom_commune not in identified_cities:
-                            
-                            # Parsing GeoJSON
-                            geojson_geom = json.loads(row.outline)
-                            inverted_outline = []
-                            # Inversion Lat/Lon pour Leaflet
-                            if geojson_geom['type'] == 'Polygon':
-                                inverted_outline = [[p[1], p[0]] for p in geojson_geom['coordinates'][0]]
-                            elif geojson_geom['type'] == 'MultiPolygon':
-                                inverted_outline = [[p[1], p[0]] for p in geojson_geom['coordinates'][0][0]]
-                            
-                            identified_cities[row.nom_commune] = {
-                                "name": row.nom_commune,
-                                "area_m2": row.area_m2,
-                                "outline": inverted_outline,
-                                "poly_obj": Polygon(inverted_outline) # Objet Shapely pour calculs précis
-                            }
+                        key = commune_key(row)
+                        city = lru_get(MUNI_CACHE, key)
+                        if city is None:
+                            city = parse_commune_row(row)
+                            lru_put(MUNI_CACHE, key, city, MAX_CACHED_COMMUNES)
+                        batch_cities.append(city)
+                        identified_cities[key] = city
+
+                    # On mémorise à quelles communes appartient chaque sonde du lot, et on retire
+                    # des lots suivants les sondes déjà couvertes par ces communes (moins d'allers-retours)
+                    probes, still_pending = batch + pending, []
+                    for k, found in enumerate(communes_of_probes(probes, batch_cities)):
+                        if found: lru_put(PROBE_CACHE, probes[k], found, MAX_CACHED_PROBES)
+                        elif k >= len(batch): still_pending.append(probes[k])
+                    pending = still_pending
                     
                     # Sécurité : Si on a déjà plus de 70 villes, on arrête le scan DB pour ne pas surcharger
                     if len(identified_cities) >= 70: break
@@ -332,24 +562,19 @@ def get_activities_route():
 
         # 3. Calcul précis des statistiques en Python (Rapide car en RAM)
         final_cities_list = []
+        cities = list(identified_cities.values())
+
+        # Un STRtree sur les contours : chaque bloc n'est testé que contre les villes dont
+        # l'emprise le contient, en un seul appel C, puis on compte les blocs par ville
+        counts = np.zeros(len(cities), dtype=np.int64)
+        if cities:
+            tree = shapely.STRtree([c['poly_obj'] for c in cities])
+            _, poly_idx = tree.query(shapely.points(cell_arr), predicate='within')
+            counts = np.bincount(poly_idx, minlength=len(cities))
         
-        for city_name, city_data in identified_cities.items():
+        for city_data, count_inside in zip(cities, counts.tolist()):
+            city_name = city_data['name']
             try:
-                # Préparation géométrique accélérée
-                poly_geom = city_data['poly_obj']
-                prepared_poly = prep(poly_geom)
-                min_lat, min_lon, max_lat, max_lon = poly_geom.bounds
-                
-                count_inside = 0
-                
-                # On vérifie quels blocs sont réellement DANS cette ville
-                for (clat, clon) in grid_store.keys():
-                    # Check rapide (Bounding Box)
-                    if min_lat <= clat <= max_lat and min_lon <= clon <= max_lon:
-                        # Check précis (Point in Polygon)
-                        if prepared_poly.contains(Point(clat, clon)):
-                            count_inside += 1
-                
                 if count_inside > 0:
                     area_conquered_m2 = count_inside * (grid_meters**2)
                     pct = (area_conquered_m2 / city_data['area_m2']) * 100
@@ -368,8 +593,10 @@ def get_activities_route():
         # On trie pour avoir les villes les plus explorées en premier
         data["top_municipalities"] = sorted(final_cities_list, key=lambda x: x['stats']['blocks'], reverse=True)
 
-    API_RESULT_CACHE[token][cache_key] = data
-    return jsonify(data)
+    # Sérialisé une seule fois par orjson : ces octets servent tels quels les appels suivants
+    body = orjson.dumps(data, option=OrjsonProvider.option)
+    lru_put(results, cache_key, body, MAX_RESULTS_PER_USER)
+    return Response(body, mimetype='application/json')
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file